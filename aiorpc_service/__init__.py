@@ -1,9 +1,12 @@
+import os
+import copy
 import json
+import functools
 import configparser
 import logging.config
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 
 from koder_utils import RAttredDict
 from aiorpc import get_http_connection_pool, ConnectionPool
@@ -20,15 +23,20 @@ service_name = 'aiorpc.service'
 INSTALL_PATH = Path(__file__).parent
 
 
-def find_in_top_tree(name: str, _cache: Dict[str, Path] = {}) -> Path:
-    if name not in _cache:
-        cpath = INSTALL_PATH
-        while not (cpath.parent / name).exists():
-            if cpath == cpath.parent:
-                raise FileExistsError(f"Can't find {name} folder in tree up from {Path(__file__).parent}")
-            cpath = cpath.parent
-        _cache[name] = cpath.parent / name
-    return _cache[name]
+@functools.lru_cache(maxsize=None)
+def _find_in_top_tree(name: str) -> Optional[Path]:
+    # negative results are cached too, so failed lookups don't walk the tree again
+    for folder in INSTALL_PATH.parents:
+        if (folder / name).exists():
+            return folder / name
+    return None
+
+
+def find_in_top_tree(name: str) -> Path:
+    res = _find_in_top_tree(name)
+    if res is None:
+        raise FileExistsError(f"Can't find {name} folder in tree up from {INSTALL_PATH}")
+    return res
 
 
 def get_files_folder() -> Path:
@@ -47,7 +55,7 @@ def get_file(name: str) -> Path:
     return get_files_folder() / name
 
 
-@dataclass
+@dataclass(frozen=True)
 class AIORPCServiceConfig:
     root: Path
     secrets: Path
@@ -73,7 +81,10 @@ class AIORPCServiceConfig:
     max_conn_total: int
     distribution_file: Path
     raw: configparser.ConfigParser
-    rraw: Any
+
+    @property
+    def rraw(self) -> Any:
+        return RAttredDict(self.raw)
 
 
 def get_config_target_path() -> Path:
@@ -95,33 +106,52 @@ def get_config_default_path() -> Optional[Path]:
             return None
 
 
-def get_config(path: Path = None) -> AIORPCServiceConfig:
-    cfg = configparser.ConfigParser()
+_CFG_CACHE: Dict[Tuple[str, int, int], AIORPCServiceConfig] = {}
+
 
+def clear_config_cache() -> None:
+    _CFG_CACHE.clear()
+
+
+def get_config(path: Path = None) -> AIORPCServiceConfig:
     if not path:
         path = get_config_default_path()
 
-    if path is None or not path.exists():
+    if path is None:
         raise FileExistsError(f"Can't find config file at {path}")
 
-    cfg.read_file(path.open())
+    path = Path(path)
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        raise FileExistsError(f"Can't find config file at {path}")
 
-    rcfg = RAttredDict(cfg)
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    if key not in _CFG_CACHE:
+        _CFG_CACHE[key] = _parse_config(path)
+    return _CFG_CACHE[key]
 
-    common = rcfg.common
-    server = rcfg.server
 
-    path_formatters: Dict[str, Any] = {'root': get_installation_root() if common.root == 'AUTO' else common.root}
+def _parse_config(path: Path) -> AIORPCServiceConfig:
+    cfg = configparser.ConfigParser()
+    with path.open() as fd:
+        cfg.read_file(fd)
 
-    for name, val in [('secrets', common.secrets), ('storage', server.storage)]:
+    common = cfg['common']
+    server = cfg['server']
+    client = cfg['client']
+
+    path_formatters: Dict[str, Any] = {'root': get_installation_root() if common['root'] == 'AUTO' else common['root']}
+
+    for name, val in [('secrets', common['secrets']), ('storage', server['storage'])]:
         path_formatters[name] = val.format(**path_formatters)
 
     def mkpath(val: str) -> Path:
         return Path(val.format(**path_formatters))
 
-    if getattr(server, "persistent_log", None):
-        persistent_log = mkpath(server.persistent_log)
-        persistent_log_level = server.persistent_log_level
+    if server.get("persistent_log"):
+        persistent_log = mkpath(server['persistent_log'])
+        persistent_log_level = server['persistent_log_level']
     else:
         persistent_log = None
         persistent_log_level = None
@@ -131,31 +161,30 @@ def get_config(path: Path = None) -> AIORPCServiceConfig:
         secrets=Path(path_formatters['secrets']),
 
         log_config=get_file("log_config.json"),
-        server_port=int(common.server_port),
-        log_level=common.log_level,
+        server_port=int(common['server_port']),
+        log_level=common['log_level'],
         config=path,
-        cmd_timeout=int(common.cmd_timeout),
+        cmd_timeout=int(common['cmd_timeout']),
 
-        storage=mkpath(server.storage),
+        storage=mkpath(server['storage']),
         persistent_log=persistent_log,
         persistent_log_level=persistent_log_level,
-        listen_ip=server.listen_ip,
+        listen_ip=server['listen_ip'],
         service_name=service_name,
         service=get_file(f"{service_name}"),
-        ssl_cert=mkpath(server.ssl_cert),
-        ssl_key=mkpath(server.ssl_key),
-        api_key_enc=mkpath(server.api_key_enc),
-        historic_ops=mkpath(server.historic_ops),
-        historic_ops_cfg=mkpath(server.historic_ops_cfg),
-        api_key=mkpath(rcfg.client.api_key),
-        ssl_cert_templ=mkpath(rcfg.client.ssl_cert_templ),
-        max_conn_total=int(rcfg.client.max_conn_total),
-        max_conn_per_node=int(rcfg.client.max_conn_per_node),
-
-        distribution_file=mkpath(rcfg.deploy.distribution_file),
-
-        raw=cfg,
-        rraw=rcfg
+        ssl_cert=mkpath(server['ssl_cert']),
+        ssl_key=mkpath(server['ssl_key']),
+        api_key_enc=mkpath(server['api_key_enc']),
+        historic_ops=mkpath(server['historic_ops']),
+        historic_ops_cfg=mkpath(server['historic_ops_cfg']),
+        api_key=mkpath(client['api_key']),
+        ssl_cert_templ=mkpath(client['ssl_cert_templ']),
+        max_conn_total=int(client['max_conn_total']),
+        max_conn_per_node=int(client['max_conn_per_node']),
+
+        distribution_file=mkpath(cfg['deploy']['distribution_file']),
+
+        raw=cfg
     )
 
 
@@ -170,15 +199,33 @@ def get_certificates(cert_name_template: Path) -> Dict[str, Path]:
 
     before_node, after_node = certs_glob.split("[node]")
 
-    for file in certs_folder.glob(certs_glob.replace('[node]', '*')):
-        node_name = file.name[len(before_node): -len(after_node)]
-        certificates[node_name] = file
+    min_len = len(before_node) + len(after_node)
+    name_end = -len(after_node) if after_node else None
+    with os.scandir(certs_folder) as entries:
+        for entry in entries:
+            fname = entry.name
+            if len(fname) > min_len and fname.startswith(before_node) and fname.endswith(after_node):
+                certificates[fname[len(before_node): name_end]] = certs_folder / fname
 
     return certificates
 
 
+@functools.lru_cache(maxsize=16)
+def _read_text_cached(path: str, mtime_ns: int) -> str:
+    return Path(path).read_text()
+
+
+def read_api_key(cfg: AIORPCServiceConfig) -> str:
+    return _read_text_cached(str(cfg.api_key), cfg.api_key.stat().st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_log_template(path: str, mtime_ns: int) -> Dict[str, Any]:
+    return json.loads(Path(path).read_text())
+
+
 def config_logging(cfg: AIORPCServiceConfig, no_persistent: bool = False):
-    log_config = json.load(cfg.log_config.open())
+    log_config = copy.deepcopy(_load_log_template(str(cfg.log_config), cfg.log_config.stat().st_mtime_ns))
 
     if not cfg.persistent_log or no_persistent:
         del log_config['handlers']['persistent']
@@ -194,11 +241,20 @@ def config_logging(cfg: AIORPCServiceConfig, no_persistent: bool = False):
     logging.config.dictConfig(log_config)
 
 
+def install_uvloop() -> bool:
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    uvloop.install()
+    return True
+
+
 def get_http_conn_pool_from_cfg(cfg: AIORPCServiceConfig = None) -> ConnectionPool:
     if cfg is None:
         cfg = get_config()
 
     certs = get_certificates(cfg.ssl_cert_templ)
-    return get_http_connection_pool(certs, cfg.api_key.open().read(),
+    return get_http_connection_pool(certs, read_api_key(cfg),
                                     max_conn_per_node=cfg.max_conn_per_node,
                                     max_conn_total=cfg.max_conn_total)
\ No newline at end of file
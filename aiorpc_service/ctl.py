@@ -1,95 +1,222 @@
+import io
+import re
 import sys
-import uuid
+import time
+import shlex
+import shutil
+import tarfile
+import tempfile
+import logging
 import asyncio
 import getpass
 import argparse
-import subprocess
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Dict, Tuple, Optional, Callable, Awaitable
 
 from koder_utils import SSH, make_secure, make_cert_and_key, rpc_map, b2ssize, read_inventory
 from aiorpc import get_http_connection_pool, get_key_enc, IAOIRPCNode
 
-from . import (get_config, get_config_default_path, AIORPCServiceConfig, config_logging, logger, get_certificates,
-               get_installation_root, get_config_target_path, get_inventory_path)
+from . import (get_config, AIORPCServiceConfig, config_logging, logger, get_certificates,
+               get_config_target_path, get_inventory_path, read_api_key,
+               root_marker, distribution, install_uvloop)
 
 
 SERVICE_FILE_DIR = Path("/lib/systemd/system")
+# same as koder_utils.SSH default ssh_opts, passing ssh_opts replaces them - keep in sync on koder_utils updates
+SSH_OPTS = "-o LogLevel=quiet -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=5"
+ARCHIVE_MARKER = b"\n__ARCHIVE_BELOW__\n"  # should be the same as in ../unpack.sh
 
 
 # --------------- SSH BASED CONTROLS FUNCTIONS -------------------------------------------------------------------------
 
 
-async def stop(service: str, nodes: List[SSH]) -> None:
-    logger.info(f"Stopping service {service} on nodes {' '.join(node.node for node in nodes)}")
-    await asyncio.gather(*[node.run(["sudo", "systemctl", "stop", service]) for node in nodes])
+def _log_nodes(message: str, nodes: List[SSH]) -> None:
+    # node list may be long, don't build it if it would not be shown
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"{message} {' '.join(node.node for node in nodes)}")
 
 
-async def disable(service: str, nodes: List[SSH]) -> None:
-    logger.info(f"Disabling service {service} on nodes {' '.join(node.node for node in nodes)}")
-    await asyncio.gather(*[node.run(["sudo", "systemctl", "disable", service]) for node in nodes])
+# All commands to a node reuse one master ssh connection. Control sockets live in a private (0700) per-run
+# folder, as predictable socket path in a shared folder could be taken over by another local user.
+# %C is a fixed length hash, so socket path doesn't depend on node name length.
+def get_ssh_opts(control_dir: str) -> str:
+    return f"{SSH_OPTS} -o ControlMaster=auto -o ControlPath={control_dir}/%C -o ControlPersist=60s"
 
 
-async def enable(service: str, nodes: List[SSH]) -> None:
-    logger.info(f"Enabling service {service} on nodes {' '.join(node.node for node in nodes)}")
-    await asyncio.gather(*[node.run(["sudo", "systemctl", "enable", service]) for node in nodes])
+# masters are persistent and run in background, they need to be stopped before control folder is removed,
+# otherwise they would keep connections open until ControlPersist timeout, with no way to reach them
+async def close_ssh_masters(control_dir: str, ssh_user: str, node_names: List[str]) -> None:
+    async def close(node_name: str) -> None:
+        # fails fast if there is no master for the node, as no new connection is made with -O
+        proc = await asyncio.create_subprocess_exec("ssh", "-o", f"ControlPath={control_dir}/%C", "-O", "exit",
+                                                    "-l", ssh_user, node_name,
+                                                    stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+        await proc.wait()
 
+    await asyncio.gather(*map(close, node_names), return_exceptions=True)
 
-async def start(service: str, nodes: List[SSH]) -> None:
-    logger.info(f"Starting service {service} on nodes {' '.join(node.node for node in nodes)}")
-    await asyncio.gather(*[node.run(["sudo", "systemctl", "start", service]) for node in nodes])
 
+# runs func for all nodes in parallel, logs errors and returns nodes, on which it failed
+async def _run_on_nodes(action: str, func: Callable[[SSH], Awaitable[Any]], nodes: List[SSH]) -> List[SSH]:
+    failed: List[SSH] = []
+    for node, val in zip(nodes, await asyncio.gather(*map(func, nodes), return_exceptions=True)):
+        if isinstance(val, Exception):
+            logger.error(f"Failed to {action} on node {node.node}: {val!s}")
+            failed.append(node)
+    return failed
 
-async def remove(cfg: AIORPCServiceConfig, nodes: List[SSH]):
-    logger.info(f"Removing rpc_agent from nodes {' '.join(node.node for node in nodes)}")
 
-    try:
-        await disable(cfg.service_name, nodes)
-    except subprocess.SubprocessError:
-        pass
+async def _svc_action(verb: str, service: str, nodes: List[SSH]) -> List[SSH]:
+    cmd = ["sudo", "systemctl", verb, service]
+    return await _run_on_nodes(f"{verb} {service}", lambda node: node.run(cmd), nodes)
 
-    try:
-        await stop(cfg.service_name, nodes)
-    except subprocess.SubprocessError:
-        pass
 
-    async def runner(node: SSH) -> None:
-        agent_folder = Path(cfg.root)
-        service_target = SERVICE_FILE_DIR / cfg.service_name
+async def stop(service: str, nodes: List[SSH]) -> List[SSH]:
+    _log_nodes(f"Stopping service {service} on nodes", nodes)
+    return await _svc_action("stop", service, nodes)
 
-        await node.run(["sudo", "rm", "--force", str(service_target)])
-        await node.run(["sudo", "systemctl", "daemon-reload"])
 
-        logger.info(f"Removing files from {node.node}")
+async def disable(service: str, nodes: List[SSH]) -> List[SSH]:
+    _log_nodes(f"Disabling service {service} on nodes", nodes)
+    return await _svc_action("disable", service, nodes)
+
+
+async def enable(service: str, nodes: List[SSH]) -> List[SSH]:
+    _log_nodes(f"Enabling service {service} on nodes", nodes)
+    return await _svc_action("enable", service, nodes)
+
+
+async def start(service: str, nodes: List[SSH]) -> List[SSH]:
+    _log_nodes(f"Starting service {service} on nodes", nodes)
+    return await _svc_action("start", service, nodes)
+
+
+async def _run_script(node: SSH, script: str) -> None:
+    await node.run(["sudo", "bash", "-s"], input_data=script.encode())
+
+
+# Makes 'bash -s' input, which runs cmd_line with data as its stdin. Bash reads scripts from a pipe byte by byte,
+# so everything after the first line stays in stdin for cmd_line. 'exit' on the same line guarantees data
+# is never executed, even if cmd_line fails before reading it.
+def _script_with_stdin(cmd_line: str, data: bytes) -> bytes:
+    return f"{cmd_line} ; exit $?\n".encode() + data
+
 
-        for folder in (agent_folder, cfg.storage):
-            await node.run(["sudo", "rm", "--preserve-root", "--recursive", "--force", str(folder)])
+async def systemctl_multi(service: str, verbs: List[str], nodes: List[SSH]) -> List[SSH]:
+    _log_nodes(f"Running {' '.join(verbs)} for service {service} on nodes", nodes)
+    script = " && ".join(f"systemctl {verb} {shlex.quote(service)}" for verb in verbs)
+    return await _run_on_nodes(f"{' '.join(verbs)} {service}", lambda node: _run_script(node, script), nodes)
 
-    for node, val in zip(nodes, await asyncio.gather(*map(runner, nodes), return_exceptions=True)):
-        if val is not None:
-            assert isinstance(val, Exception)
-            logger.error(f"Failed on node {node} with message: {val!s}")
 
-    logger.info(f"Removing local config and inventory")
-    if get_config_target_path().exists():
-        get_config_target_path().unlink()
+async def _read_bytes(path: Path) -> bytes:
+    return await asyncio.get_running_loop().run_in_executor(None, path.read_bytes)
 
-    if get_inventory_path().exists():
-        get_inventory_path().unlink()
 
+async def _write_bytes(path: Path, data: bytes) -> None:
+    await asyncio.get_running_loop().run_in_executor(None, path.write_bytes, data)
 
-async def deploy(cfg: AIORPCServiceConfig, nodes: List[SSH], max_parallel_uploads: int, inventory: List[str]):
+
+# distribution is a self-extracting script (see unpack.sh)
+# returns (tar compression option, number of the first line of tar archive), same as unpack.sh computes it
+def _parse_distribution(data: bytes) -> Tuple[str, int]:
+    header, marker, archive = data.partition(ARCHIVE_MARKER)
+    tar_opt = re.search(r'^readonly TAR_OPT="(--\w+)"', header.decode(), re.MULTILINE)
+    if not marker or not archive or not tar_opt:
+        raise ValueError("Distribution file has unexpected format")
+    return tar_opt.group(1), header.count(b"\n") + 3
+
+
+# shell command, which does the same as 'distribution.sh --install' with distribution on its stdin:
+# make dirs, save distribution to the install root while unpacking its archive part, put install root marker
+def _install_cmd(root: Path, dirs: List[Path], archive_line: int, tar_opt: str) -> str:
+    root_q = shlex.quote(str(root))
+    dirs_q = " ".join(shlex.quote(str(folder)) for folder in [root] + dirs)
+    return (f"set -o pipefail && mkdir --parents {dirs_q} && " +
+            f"tee {shlex.quote(str(root / distribution))} | tail --lines=+{archive_line} | " +
+            f"tar --extract {tar_opt} --file=- --directory={root_q} && " +
+            f"touch {shlex.quote(str(root / root_marker))}")
+
+
+# files is {absolute_remote_path: (content, mode)}, result should be extracted with 'tar --extract --directory=/'
+def _make_tar(files: Dict[str, Tuple[bytes, int]]) -> bytes:
+    buf = io.BytesIO()
+    mtime = int(time.time())
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for path, (data, mode) in files.items():
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = mtime
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+async def remove(cfg: AIORPCServiceConfig, nodes: List[SSH]) -> List[SSH]:
+    _log_nodes("Removing rpc_agent from nodes", nodes)
+
+    service = shlex.quote(cfg.service_name)
+    service_target = shlex.quote(str(SERVICE_FILE_DIR / cfg.service_name))
+    folders = " ".join(shlex.quote(str(folder)) for folder in (cfg.root, cfg.storage))
+
+    # single ssh call per node, disable/stop failures are ignored as service may be already gone
+    script = "\n".join([
+        "set -o errexit",
+        f"systemctl disable {service} || true",
+        f"systemctl stop {service} || true",
+        f"rm --force {service_target}",
+        "systemctl daemon-reload",
+        f"rm --preserve-root --recursive --force {folders}",
+    ])
+
+    async def runner(node: SSH) -> Tuple[SSH, Optional[Exception]]:
+        logger.info(f"Removing files from {node.node}")
+        try:
+            await _run_script(node, script)
+        except Exception as exc:
+            return node, exc
+        return node, None
+
+    def remove_local_files() -> None:
+        logger.info("Removing local config and inventory")
+        for path in (get_config_target_path(), get_inventory_path()):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    # local cleanup doesn't depend on nodes, and errors are reported as soon as each node is done
+    local_cleanup = asyncio.get_running_loop().run_in_executor(None, remove_local_files)
+    failed: List[SSH] = []
+    for res in asyncio.as_completed([runner(node) for node in nodes]):
+        node, exc = await res
+        if exc is not None:
+            logger.error(f"Failed on node {node.node} with message: {exc!s}")
+            failed.append(node)
+    await local_cleanup
+    return failed
+
+
+async def deploy(cfg: AIORPCServiceConfig, nodes: List[SSH], max_parallel_uploads: int, inventory: List[str],
+                 max_parallel_ssh: int = 0) -> List[SSH]:
     logger.info(f"Start deploying on nodes: {' '.join(inventory)}")
 
     if cfg.config != get_config_target_path():
         logger.info(f"Copying config to: {get_config_target_path()}")
-        get_config_target_path().open("w").write(cfg.config.open().read())
+        await _write_bytes(get_config_target_path(), await _read_bytes(cfg.config))
 
     upload_semaphore = asyncio.Semaphore(max_parallel_uploads if max_parallel_uploads else len(nodes))
+    # each node runs at most 2 ssh commands at once - install and push_service, secrets are uploaded after them
+    ssh_semaphore = asyncio.Semaphore(max_parallel_ssh if max_parallel_ssh else 2 * len(nodes))
 
     if max_parallel_uploads:
         logger.debug(f"Max uploads is set to {max_parallel_uploads}")
 
+    if max_parallel_ssh:
+        logger.debug(f"Max parallel ssh commands is set to {max_parallel_ssh}")
+
     cfg.secrets.mkdir(mode=0o770, parents=True, exist_ok=True)
 
     make_secure(cfg.api_key, cfg.api_key_enc)
@@ -103,58 +230,79 @@ async def deploy(cfg: AIORPCServiceConfig, nodes: List[SSH], max_parallel_upload
 
     logger.debug(f"Api keys generated")
 
-    async def runner(node: SSH):
-        logger.debug(f"Start deploying node {node.node}")
-
-        await node.run(["sudo", "mkdir", "--parents", cfg.root])
-        await node.run(["sudo", "mkdir", "--parents", cfg.storage])
-
-        temp_distr_file = f"/tmp/distribution_{uuid.uuid1()!s}.{cfg.distribution_file.name.split('.')[1]}"
-
-        logger.debug(f"Copying {b2ssize(cfg.distribution_file.stat().st_size)}B of archive to {node.node}")
+    # distribution is the same for all nodes - read it once, not once per node, and install it from ssh stdin,
+    # instead of uploading it to a temporary file first
+    distribution_data = await _read_bytes(cfg.distribution_file)
+    tar_opt, archive_line = _parse_distribution(distribution_data)
+    distribution_size = b2ssize(len(distribution_data))
+
+    api_enc_key_data = api_enc_key.encode("utf8")
+    root_s = str(cfg.root)
+    service_content = (await _read_bytes(cfg.service)).decode()
+    service_content = service_content.replace("{INSTALL}", root_s)
+    service_content = service_content.replace("{CONFIG_PATH}", str(cfg.config))
+    service_content_data = service_content.encode()
+    root_q = shlex.quote(root_s)
+    # one ssh call per node for the whole install, including permissions fix
+    install_script = _script_with_stdin(_install_cmd(cfg.root, [cfg.storage, cfg.secrets], archive_line, tar_opt) +
+                                        f" && chown --recursive root:root {root_q} && chmod --recursive o-w {root_q}",
+                                        distribution_data)
+    service_q = shlex.quote(str(SERVICE_FILE_DIR / cfg.service_name))
+    push_service_script = _script_with_stdin(f"cat > {service_q} && systemctl daemon-reload", service_content_data)
+    ssl_cert_s, ssl_key_s, api_key_enc_s = str(cfg.ssl_cert), str(cfg.ssl_key), str(cfg.api_key_enc)
+    ssl_cert_prefix, ssl_cert_suffix = str(cfg.ssl_cert_templ).split("[node]")
+
+    async def run(node: SSH, cmd: List[str], **kwargs) -> Any:
+        async with ssh_semaphore:
+            return await node.run(cmd, **kwargs)
+
+    async def install(node: SSH) -> None:
+        logger.debug(f"Installing {distribution_size}B of archive to {node.node}")
         async with upload_semaphore:
-            await node.copy(cfg.distribution_file, temp_distr_file)
+            await run(node, ["sudo", "bash", "-s"], input_data=install_script)
 
-        logger.debug(f"Installing distribution and making dirs on {node.node}")
-        # await node.run(["sudo", "tar", "--xz", "--extract", "--directory=" +
-        #   str(cfg.root), "--file", temp_distr_file])
-        await node.run(["sudo", "bash", temp_distr_file, "--install", str(cfg.root)])
-        await node.run(["sudo", "chown", "--recursive", "root.root", cfg.root])
-        await node.run(["sudo", "chmod", "--recursive", "o-w", cfg.root])
-        await node.run(["sudo", "mkdir", "--parents", cfg.secrets])
+    async def push_service(node: SSH) -> None:
+        logger.debug(f"Copying service file to {node.node}")
+        await run(node, ["sudo", "bash", "-s"], input_data=push_service_script)
 
+    async def prepare_secrets(node: SSH) -> bytes:
         logger.debug(f"Generating certs for {node.node}")
-        ssl_cert_file = Path(str(cfg.ssl_cert_templ).replace("[node]", node.node))
+        ssl_cert_file = Path(f"{ssl_cert_prefix}{node.node}{ssl_cert_suffix}")
         ssl_key_file = cfg.secrets / f'key.{node.node}.tempo'
         make_secure(ssl_cert_file, ssl_key_file)
 
         await make_cert_and_key(ssl_key_file, ssl_cert_file,
                                 f"/C=NN/ST=Some/L=Some/O=aiorpc/OU=aiorpc/CN={node.node}")
 
-        logger.debug(f"Copying certs and keys to {node.node}")
-        await node.run(["sudo", "tee", cfg.ssl_cert], input_data=ssl_cert_file.open("rb").read())
-        await node.run(["sudo", "tee", cfg.ssl_key], input_data=ssl_key_file.open("rb").read())
-        await node.run(["sudo", "tee", cfg.api_key_enc], input_data=api_enc_key.encode("utf8"))
+        ssl_cert_data, ssl_key_data = await asyncio.gather(_read_bytes(ssl_cert_file), _read_bytes(ssl_key_file))
+        secrets_tar = _make_tar({
+            ssl_cert_s: (ssl_cert_data, 0o644),
+            ssl_key_s: (ssl_key_data, 0o600),
+            api_key_enc_s: (api_enc_key_data, 0o600),
+        })
         ssl_key_file.unlink()
-        await node.run(["rm", temp_distr_file])
+        return secrets_tar
 
-        logger.debug(f"Copying service file to {node.node}")
-        service_content = cfg.service.open().read()
-        service_content = service_content.replace("{INSTALL}", str(cfg.root))
-        service_content = service_content.replace("{CONFIG_PATH}", str(cfg.config))
+    async def runner(node: SSH):
+        logger.debug(f"Start deploying node {node.node}")
+
+        # local cert generation, archive install and service file upload don't depend on each other
+        secrets_tar, _, _ = await asyncio.gather(prepare_secrets(node), install(node), push_service(node))
 
-        await node.run(["sudo", "tee", f"/lib/systemd/system/{cfg.service_name}"],
-                       input_data=service_content.encode())
-        await node.run(["sudo", "systemctl", "daemon-reload"])
+        # secrets folder is created by install
+        logger.debug(f"Copying certs and keys to {node.node}")
+        await run(node, ["sudo", "tar", "--extract", "--preserve-permissions", "--file=-", "--directory=/"],
+                  input_data=secrets_tar)
         logger.debug(f"Done with {node.node}")
 
     await asyncio.gather(*map(runner, nodes))
-    await enable(cfg.service_name, nodes)
-    await start(cfg.service_name, nodes)
+    failed = await systemctl_multi(cfg.service_name, ["enable", "start"], nodes)
 
     with get_inventory_path().open("w") as fd:
         fd.write("\n".join(inventory) + "\n")
 
+    return failed
+
 
 # --------------- RPC BASED CONTROLS FUNCTIONS -------------------------------------------------------------------------
 
@@ -165,56 +313,53 @@ async def check_node(conn: IAOIRPCNode, hostname: str) -> bool:
 
 async def status(cfg: AIORPCServiceConfig, nodes: List[str]) -> None:
     ssl_certs = get_certificates(cfg.ssl_cert_templ)
-    pool_am = get_http_connection_pool(ssl_certs, cfg.api_key.open().read(), cfg.max_conn_per_node, port=cfg.server_port)
+    pool_am = get_http_connection_pool(ssl_certs, read_api_key(cfg), cfg.max_conn_per_node, port=cfg.server_port)
+    # limit in-flight probes, so pool can reuse connections instead of opening one per node at once
+    probe_semaphore = asyncio.Semaphore(min(len(nodes), cfg.max_conn_total))
+
+    async def bounded_check_node(conn: IAOIRPCNode, hostname: str) -> bool:
+        async with probe_semaphore:
+            return await check_node(conn, hostname)
+
     async with pool_am as pool:
         max_node_name_len = max(map(len, nodes))
-        async for node_name, res in rpc_map(pool, check_node, nodes):
+        fmt = f"%{max_node_name_len}s %8s"
+        async for node_name, res in rpc_map(pool, bounded_check_node, nodes):
             if isinstance(res, Exception):
                 logger.error(f"{node_name} - error: {res!s}")
             else:
-                logger.info("{0:>{1}} {2:>8}".format(node_name, max_node_name_len, "RUN" if res else "NOT RUN"))
+                logger.info(fmt, node_name, "RUN" if res else "NOT RUN")
 
 
 def parse_args(argv: List[str]) -> Any:
-    try:
-        inst_root = get_installation_root()
-        cfg_def_path = get_config_default_path()
-    except RuntimeError:
-        inst_root = None
-        cfg_def_path = None
+    # defaults which need filesystem lookups are resolved in main, only for commands which use them
+    config_parent = argparse.ArgumentParser(add_help=False)
+    config_parent.add_argument("--config", metavar='CONFIG_FILE', default=None, type=Path,
+                               help="Config file path (default: installed config or the one from package files)")
+
+    ssh_parent = argparse.ArgumentParser(add_help=False)
+    ssh_parent.add_argument("--ssh-user", metavar='SSH_USER', default=None,
+                            help="SSH user, (default: current user)")
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     subparsers = parser.add_subparsers(dest='subparser_name')
+    subparsers.required = True
 
-    deploy_parser = subparsers.add_parser('install', help='Deploy agent on nodes from inventory')
+    deploy_parser = subparsers.add_parser('install', help='Deploy agent on nodes from inventory',
+                                          parents=[ssh_parent, config_parent])
     deploy_parser.add_argument("--max-parallel-uploads", default=0, type=int,
                                help="Max parallel archive uploads to target nodes (default: %(default)s)")
-    if inst_root:
-        deploy_parser.add_argument("--target", metavar='TARGET_FOLDER', default=inst_root,
-                                   help="Path to deploy agent to on target nodes (default: %(default)s)")
-    else:
-        deploy_parser.add_argument("--target", metavar='TARGET_FOLDER', required=True,
-                                   help="Path to deploy agent to on target nodes (default: %(default)s)")
-
+    deploy_parser.add_argument("--max-parallel-ssh", default=0, type=int,
+                               help="Max parallel ssh commands, 0 - no limit (default: %(default)s)")
+    deploy_parser.add_argument("--target", metavar='TARGET_FOLDER', default=None,
+                               help="Path to deploy agent to on target nodes (default: local installation root)")
     deploy_parser.add_argument("--inventory", metavar='INVENTORY_FILE', required=True, type=Path,
                                help="Path to file with list of ssh ip/names of ceph nodes")
 
-    stop_parser = subparsers.add_parser('stop', help='Stop daemons')
-    start_parser = subparsers.add_parser('start', help='Start daemons')
-    remove_parser = subparsers.add_parser('uninstall', help='Remove service')
-
-    for sbp in (deploy_parser, start_parser, stop_parser, remove_parser):
-        sbp.add_argument("--ssh-user", metavar='SSH_USER', default=getpass.getuser(),
-                         help="SSH user, (default: %(default)s)")
-
-    status_parser = subparsers.add_parser('status', help='Show daemons statuses')
-    for sbp in (deploy_parser, start_parser, stop_parser, status_parser, remove_parser):
-        if cfg_def_path:
-            sbp.add_argument("--config", metavar='CONFIG_FILE', default=cfg_def_path,
-                             help="Config file path (default: %(default)s)")
-        else:
-            sbp.add_argument("--config", metavar='CONFIG_FILE', required=True,
-                             help="Config file path (default: %(default)s)")
+    subparsers.add_parser('stop', help='Stop daemons', parents=[ssh_parent, config_parent])
+    subparsers.add_parser('start', help='Start daemons', parents=[ssh_parent, config_parent])
+    subparsers.add_parser('uninstall', help='Remove service', parents=[ssh_parent, config_parent])
+    subparsers.add_parser('status', help='Show daemons statuses', parents=[config_parent])
 
     return parser.parse_args(argv[1:])
 
@@ -224,6 +369,7 @@ def main(argv: List[str]) -> int:
 
     cfg = get_config(opts.config)
     config_logging(cfg, no_persistent=True)
+    install_uvloop()
 
     if opts.subparser_name == 'status':
         inventory = read_inventory(get_inventory_path())
@@ -235,18 +381,23 @@ def main(argv: List[str]) -> int:
     else:
         inventory = read_inventory(get_inventory_path())
 
-    nodes = [SSH(name_or_ip, ssh_user=opts.ssh_user) for name_or_ip in inventory]
-    if opts.subparser_name == 'install':
-        asyncio.run(deploy(cfg, nodes, max_parallel_uploads=opts.max_parallel_uploads, inventory=inventory))
-    elif opts.subparser_name == 'start':
-        asyncio.run(start(cfg.service_name, nodes))
-    elif opts.subparser_name == 'stop':
-        asyncio.run(stop(cfg.service_name, nodes))
-    elif opts.subparser_name == 'uninstall':
-        asyncio.run(remove(cfg, nodes))
-    else:
-        assert False, f"Unknown command {opts.subparser_name}"
-    return 0
+    ssh_user = opts.ssh_user if opts.ssh_user else getpass.getuser()
+    control_dir = tempfile.mkdtemp(prefix="aiorpc-ssh-")
+    try:
+        ssh_opts = get_ssh_opts(control_dir)
+        nodes = [SSH(name_or_ip, ssh_user=ssh_user, ssh_opts=ssh_opts) for name_or_ip in inventory]
+        handlers = {
+            'install': lambda: deploy(cfg, nodes, max_parallel_uploads=opts.max_parallel_uploads, inventory=inventory,
+                                      max_parallel_ssh=opts.max_parallel_ssh),
+            'start': lambda: start(cfg.service_name, nodes),
+            'stop': lambda: stop(cfg.service_name, nodes),
+            'uninstall': lambda: remove(cfg, nodes),
+        }
+        failed = asyncio.run(handlers[opts.subparser_name]())
+    finally:
+        asyncio.run(close_ssh_masters(control_dir, ssh_user, inventory))
+        shutil.rmtree(control_dir, ignore_errors=True)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
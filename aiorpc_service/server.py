@@ -2,11 +2,11 @@ import sys
 import argparse
 import logging.config
 from pathlib import Path
-from typing import List
+from typing import List, Any
 
 from aiorpc import start_rpc_server, configure, get_key_enc
 
-from . import get_config, config_logging
+from . import get_config, config_logging, install_uvloop
 
 
 logger = logging.getLogger("agent")
@@ -15,29 +15,34 @@ logger = logging.getLogger("agent")
 def parse_args(argv: List[str]):
     p = argparse.ArgumentParser()
     subparsers = p.add_subparsers(dest='subparser_name')
+    subparsers.required = True
     server = subparsers.add_parser('server', help='Run web server')
     server.add_argument("--config", required=True, help="Config file path")
     subparsers.add_parser('gen_key', help='Generate new key')
     return p.parse_args(argv[1:])
 
 
-def main(argv: List[str]) -> int:
-    opts = parse_args(argv)
+def run_server(opts: Any) -> None:
     cfg = get_config(Path(opts.config))
     config_logging(cfg)
+    install_uvloop()
+    configure(historic_ops=cfg.historic_ops, historic_ops_cfg=cfg.historic_ops_cfg)
+    start_rpc_server(ip=cfg.listen_ip,
+                     ssl_cert=cfg.ssl_cert,
+                     ssl_key=cfg.ssl_key,
+                     api_key_enc=cfg.api_key_enc.open().read(),
+                     port=cfg.server_port)
+
+
+def gen_key(opts: Any) -> None:
+    key, enc_key = get_key_enc()
+    print(f"Key={key}\nenc_key={enc_key}")
 
-    if opts.subparser_name == 'server':
-        configure(historic_ops=cfg.historic_ops, historic_ops_cfg=cfg.historic_ops_cfg)
-        start_rpc_server(ip=cfg.listen_ip,
-                         ssl_cert=cfg.ssl_cert,
-                         ssl_key=cfg.ssl_key,
-                         api_key_enc=cfg.api_key_enc.open().read(),
-                         port=cfg.server_port)
-    elif opts.subparser_name == 'gen_key':
-        key, enc_key = get_key_enc()
-        print(f"Key={key}\nenc_key={enc_key}")
-    else:
-        assert False, f"Unknown cmd {opts.subparser_name}"
+
+def main(argv: List[str]) -> int:
+    opts = parse_args(argv)
+    handlers = {'server': run_server, 'gen_key': gen_key}
+    handlers[opts.subparser_name](opts)
     return 0
 
 
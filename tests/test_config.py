@@ -0,0 +1,49 @@
+from pathlib import Path
+
+import pytest
+
+from aiorpc_service import get_config
+
+
+FULL_CFG = """
+[common]
+root = {root}
+secrets = {{root}}/secrets
+server_port = 55667
+log_level = DEBUG
+cmd_timeout = 30
+
+[server]
+storage = /var/lib/aiorpc
+listen_ip = 0.0.0.0
+ssl_cert = {{secrets}}/ssl_cert.cert
+ssl_key = {{secrets}}/{{{{root}}}}.key
+api_key_enc = {{secrets}}/api_key.enc
+historic_ops = {{storage}}/historic_ops.bin
+historic_ops_cfg = {{storage}}/historic_ops.json
+
+[client]
+api_key = {{secrets}}/api.key
+ssl_cert_templ = {{secrets}}/ssl_cert.[node].cert
+max_conn_per_node = 16
+max_conn_total = 128
+
+[deploy]
+distribution_file = {{root}}/distribution.sh
+"""
+
+
+@pytest.mark.parametrize("root", ["/opt/aiorpc", "/opt/ai{{o}}rpc"])
+def test_config_paths_same_as_format(tmp_path: Path, root: str):
+    cfg_path = tmp_path / "config.cfg"
+    cfg_path.write_text(FULL_CFG.format(root=root))
+    cfg = get_config(cfg_path)
+
+    formatters = {'root': root}
+    formatters['secrets'] = "{root}/secrets".format(**formatters)
+    formatters['storage'] = "/var/lib/aiorpc"
+
+    assert cfg.ssl_cert == Path("{secrets}/ssl_cert.cert".format(**formatters))
+    assert cfg.ssl_key == Path("{secrets}/{{root}}.key".format(**formatters))
+    assert cfg.historic_ops == Path("{storage}/historic_ops.bin".format(**formatters))
+    assert cfg.distribution_file == Path("{root}/distribution.sh".format(**formatters))
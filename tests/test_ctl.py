@@ -0,0 +1,101 @@
+import io
+import shlex
+import tarfile
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from aiorpc_service.ctl import _parse_distribution, _script_with_stdin, _install_cmd, _make_tar
+
+
+UNPACK_SH = Path(__file__).parent.parent / "unpack.sh"
+
+
+def make_distribution(tar_opt: str = "--xz") -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:xz" if tar_opt == "--xz" else "w:gz") as tar:
+        for name, data in [("usr/bin/tool", b"#!/bin/sh\n"), ("lib/data.bin", bytes(range(256)) * 16)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return UNPACK_SH.read_bytes().replace(b"{FILL_TAR_OPT}", tar_opt.encode()) + buf.getvalue()
+
+
+def run_script(script: bytes) -> subprocess.CompletedProcess:
+    return subprocess.run(["bash", "-s"], input=script, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+@pytest.mark.parametrize("tar_opt", ["--xz", "--gzip"])
+def test_parse_distribution(tmp_path: Path, tar_opt: str):
+    data = make_distribution(tar_opt)
+    found_opt, archive_line = _parse_distribution(data)
+    assert found_opt == tar_opt
+
+    # must match line computed by unpack.sh itself
+    distr = tmp_path / "distribution.sh"
+    distr.write_bytes(data)
+    awk = subprocess.run(["awk", "/^__ARCHIVE_BELOW__/ {print NR + 1; exit 0; }", str(distr)],
+                         stdout=subprocess.PIPE, check=True)
+    assert int(awk.stdout) == archive_line
+
+
+@pytest.mark.parametrize("data", [b"", b"#!/bin/bash\necho\n", UNPACK_SH.read_bytes() + b"archive"])
+def test_parse_distribution_broken(data: bytes):
+    with pytest.raises(ValueError):
+        _parse_distribution(data)
+
+
+def test_script_with_stdin(tmp_path: Path):
+    data = b"first line\nexit 1\n\x00\xff binary\n"
+    target = tmp_path / "target"
+    res = run_script(_script_with_stdin(f"cat > {shlex.quote(str(target))}", data))
+    assert res.returncode == 0
+    assert target.read_bytes() == data
+
+
+def test_script_with_stdin_never_runs_data(tmp_path: Path):
+    marker = tmp_path / "marker"
+    res = run_script(_script_with_stdin("false", f"touch {shlex.quote(str(marker))}\n".encode()))
+    assert res.returncode == 1
+    assert not marker.exists()
+
+
+def test_install_same_as_unpack_sh(tmp_path: Path):
+    data = make_distribution()
+    tar_opt, archive_line = _parse_distribution(data)
+
+    distr = tmp_path / "distribution.sh"
+    distr.write_bytes(data)
+    expected_root = tmp_path / "expected"
+    subprocess.run(["bash", str(distr), "--install", str(expected_root)], check=True)
+
+    root = tmp_path / "root"
+    storage = tmp_path / "storage"
+    res = run_script(_script_with_stdin(_install_cmd(root, [storage], archive_line, tar_opt), data))
+    assert res.returncode == 0, res.stderr
+    assert storage.is_dir()
+
+    def files(path: Path):
+        return {str(fl.relative_to(path)): fl.read_bytes() for fl in path.rglob("*") if fl.is_file()}
+
+    # includes distribution.sh copy and .install_root marker
+    assert files(root) == files(expected_root)
+
+
+def test_install_cmd_fails_on_broken_archive(tmp_path: Path):
+    data = make_distribution()
+    tar_opt, archive_line = _parse_distribution(data)
+    root = tmp_path / "root"
+    res = run_script(_script_with_stdin(_install_cmd(root, [], archive_line, tar_opt), data[:-100]))
+    assert res.returncode != 0
+    assert not (root / ".install_root").exists()
+
+
+def test_make_tar_plain_ustar():
+    data = _make_tar({"/opt/aiorpc/secrets/ssl.cert": (b"cert", 0o644), "/opt/aiorpc/secrets/ssl.key": (b"key", 0o600)})
+    assert b"PaxHeader" not in data
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        members = {info.name: (tar.extractfile(info).read(), info.mode, info.uid) for info in tar.getmembers()}
+    assert members == {"opt/aiorpc/secrets/ssl.cert": (b"cert", 0o644, 0),
+                       "opt/aiorpc/secrets/ssl.key": (b"key", 0o600, 0)}